@@ -0,0 +1,15 @@
+# gunicorn.conf.py — chargé automatiquement par `gunicorn main:app`
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+# WEB_CONCURRENCY : convention Heroku/Cloud Run, reprise ici car ce fichier prime sur l'env.
+# Chaque worker peut aussi avoir son pool de pages (main.py, PDF_POOL_WORKERS) : process
+# MuPDF au total = workers × pool ; le défaut du pool divise les CPU par ce nombre de workers.
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+# threads : l'upload et l'envoi (streaming) d'une requête se recouvrent avec le parsing
+# d'une autre ; le travail CPU lourd part dans le pool de process (main.py)
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "2"))
+timeout = 120
+# import (fitz, warm-up MuPDF) fait une fois dans le master, partagé en copy-on-write
+preload_app = True
@@ -1,73 +1,310 @@
 # main.py
-import io
 import os
+import re
+import hashlib
 import logging
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import chain
 from math import isfinite
-from typing import List, Optional, Tuple, Dict, Any
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple, Dict, Any, Iterator, Union
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, stream_with_context
+from flask_compress import Compress
 import fitz  # PyMuPDF
+import numpy as np
+import orjson
+from werkzeug.exceptions import HTTPException
 
 app = Flask(__name__)
+# Corps refusé (413) avant lecture au-delà de MAX_PDF_MB : Content-Length vérifié d'entrée,
+# flux chunked / multipart coupés à la limite par Werkzeug. Le Content-Length d'une partie
+# multipart n'est pas borné par cette limite : _read_pdf_bytes l'ignore s'il dépasse le corps.
+# MAX_PDF_MB=0 : pas de limite.
+_MAX_PDF_MB = int(os.getenv("MAX_PDF_MB", "64"))
+app.config["MAX_CONTENT_LENGTH"] = _MAX_PDF_MB * 1024 * 1024 if _MAX_PDF_MB > 0 else None
+# Réponses JSON compressées selon Accept-Encoding (zstd sinon gzip), y compris les flux
+# /parse et /fulltext ; le cache de réponses garde les corps non compressés.
+app.config.update(
+    COMPRESS_MIMETYPES=["application/json"],
+    COMPRESS_LEVEL=5,
+    COMPRESS_MIN_SIZE=1024,
+    COMPRESS_ALGORITHM=["zstd", "gzip"],
+    COMPRESS_ALGORITHM_STREAMING=["zstd", "gzip"],
+)
+Compress(app)
 logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO"),
     format="%(asctime)s %(levelname)s %(name)s: %(message)s",
 )
 logger = app.logger
 
+# ---------- MuPDF ----------
+# Les PDF malformés font écrire MuPDF sur stderr à chaque ouverture ; on garde ses
+# messages dans fitz.TOOLS.mupdf_warnings() sans les imprimer.
+fitz.TOOLS.mupdf_display_errors(False)
+
+def _warmup_mupdf():
+    """
+    Paye l'initialisation MuPDF (fonts, glyph cache, extraction de texte) au chargement
+    plutôt qu'à la 1re requête. Avec preload_app (gunicorn.conf.py) c'est fait une fois
+    dans le master, dont les workers gunicorn héritent ; le forkserver du pool l'importe et
+    le refait une fois, ses process en héritent.
+    """
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "warm-up")
+    data = doc.tobytes()
+    doc.close()
+    doc = fitz.open(stream=data, filetype="pdf")
+    doc[0].get_text("words")
+    doc.close()
+
+if os.environ.get("WARMUP_PDF", "1") == "1":
+    _warmup_mupdf()
+
+# Le store MuPDF (objets/fonts/images décodés) n'est pas borné et PyMuPDF n'expose ni sa
+# taille ni sa limite : on le vide (en %) après chaque requête / bloc de pages pour garder
+# un RSS stable. Chaque requête ouvre un document neuf, il n'y a presque rien à réutiliser.
+# MUPDF_STORE_SHRINK=0 désactive.
+MUPDF_STORE_SHRINK = int(os.getenv("MUPDF_STORE_SHRINK", "100"))
+
+def _shrink_mupdf_store():
+    if MUPDF_STORE_SHRINK > 0:
+        fitz.TOOLS.store_shrink(MUPDF_STORE_SHRINK)
+
 # ---------- Utils ----------
-def is_green(color_rgb: Optional[Tuple[float, float, float]]) -> bool:
-    if not color_rgb:
-        return False
-    r, g, b = color_rgb
-    return (g >= 0.6) and (g >= r + 0.10) and (g >= b + 0.10)
-
-def rect_from_quad_list(q: List[float]) -> fitz.Rect:
-    xs = q[0::2]
-    ys = q[1::2]
-    return fitz.Rect(min(xs), min(ys), max(xs), max(ys))
-
-def add_text_from_rect(page: fitz.Page, r: fitz.Rect, texts: List[str], bboxes: List[List[float]]):
-    t = page.get_text("text", clip=r).strip()
-    if t:
-        texts.append(t)
-        bboxes.append([float(r.x0), float(r.y0), float(r.x1), float(r.y1)])
+def _is_green_batch(c: np.ndarray) -> np.ndarray:
+    """Surlignages « verts » : couleurs (N,3) → masque booléen (N,) (g >= 0.6, g >= r/b + 0.10)."""
+    return (c[:, 1] >= 0.6) & (c[:, 1] >= c[:, 0] + 0.10) & (c[:, 1] >= c[:, 2] + 0.10)
 
-def _sanitize_json(x: Any) -> Any:
-    """Rend tout sérialisable JSON (NaN/Inf→None, tuples→list, Rect→bbox)."""
-    if isinstance(x, float):
-        return x if isfinite(x) else None
-    if isinstance(x, (int, str, type(None), bool)):
-        return x
-    if isinstance(x, tuple):
-        return [_sanitize_json(v) for v in x]
-    if isinstance(x, list):
-        return [_sanitize_json(v) for v in x]
-    if isinstance(x, dict):
-        return {str(k): _sanitize_json(v) for k, v in x.items()}
-    if hasattr(x, "x0") and hasattr(x, "y0") and hasattr(x, "x1") and hasattr(x, "y1"):
+@lru_cache(maxsize=512)
+def _font_is_bold(font: str) -> bool:
+    """Heuristique « gras » sur le nom de police (peu de polices distinctes, mémoïsé)."""
+    return "bold" in font.lower()
+
+def _points_flat(v) -> np.ndarray:
+    return np.asarray(v, dtype=np.float32).ravel()
+
+def _points_xy(v) -> np.ndarray:
+    return np.fromiter((c for p in v for c in (p.x, p.y)), dtype=np.float32)
+
+# type du 1er vertex → coordonnées à plat [x, y, x, y, …]
+_VERTEX_POINTS = {
+    tuple: _points_flat,       # paires (x, y) (PyMuPDF récent)
+    list: _points_flat,
+    float: _points_flat,       # liste plate, 8 valeurs par quad
+    int: _points_flat,
+    fitz.Point: _points_xy,
+}
+
+def _quads_to_rects(v) -> np.ndarray:
+    """
+    Vertices d'annotation → (n,4) float32 [x0, y0, x1, y1], tous les quads en un seul min/max.
+    Formats: Quads, Points ou paires (x, y) par 4, liste plate par 8 ; quad incomplet ignoré.
+    """
+    if not v:
+        return np.empty((0, 4), dtype=np.float32)
+    kind = type(v[0])
+    if kind is fitz.Quad:
+        return np.array([tuple(q.rect) for q in v], dtype=np.float32).reshape(-1, 4)
+    to_points = _VERTEX_POINTS.get(kind)
+    if to_points is None:
+        return np.empty((0, 4), dtype=np.float32)
+    pts = to_points(v)
+    n = len(pts) // 8
+    quads = pts[:n * 8].reshape(n, 4, 2)
+    return np.column_stack([quads.min(axis=1), quads.max(axis=1)])
+
+def _page_words_cache(page: fitz.Page) -> Tuple[np.ndarray, List[str], List[Tuple[int, int]]]:
+    """
+    Mots de la page extraits une seule fois (attaché à `page` pour la durée de la requête)
+    → (bboxes (N,4) float32, mots, (block, line) de chaque mot).
+    Réutilise la TextPage de la page si /parse en a déjà construit une (`page._textpage`).
+    """
+    cache = getattr(page, "_words_cache", None)
+    if cache is None:
         try:
-            return [float(x.x0), float(x.y0), float(x.x1), float(x.y1)]
+            words = page.get_text("words", textpage=getattr(page, "_textpage", None))
         except Exception:
-            return None
-    return str(x)
-
-def _rects_overlap(r1: fitz.Rect, r2: fitz.Rect, min_iou: float = 0.05) -> bool:
-    inter = fitz.Rect(max(r1.x0, r2.x0), max(r1.y0, r2.y0), min(r1.x1, r2.x1), min(r1.y1, r2.y1))
-    if inter.x1 <= inter.x0 or inter.y1 <= inter.y0:
-        return False
-    inter_area = (inter.x1 - inter.x0) * (inter.y1 - inter.y0)
-    a1 = (r1.x1 - r1.x0) * (r1.y1 - r1.y0)
-    a2 = (r2.x1 - r2.x0) * (r2.y1 - r2.y0)
-    denom = max(a1 + a2 - inter_area, 1e-6)
-    iou = inter_area / denom
-    return iou >= min_iou
+            logger.exception("words extraction failed on page %s", page.number + 1)
+            words = []
+        boxes = np.array([w[:4] for w in words], dtype=np.float32).reshape(-1, 4)
+        cache = (boxes, [w[4] for w in words], [(w[5], w[6]) for w in words])
+        page._words_cache = cache
+    return cache
+
+def text_in_rect(page: fitz.Page, r: fitz.Rect, taken: Optional[np.ndarray] = None) -> str:
+    """
+    Équivalent de page.get_text("text", clip=r).strip() à partir du cache de mots.
+    Les mots ne contiennent jamais d'espace : le texte est déjà « strippé ».
+    `taken` (masque booléen par mot, cf. _words_taken) : mots déjà pris par un autre quad
+    de la même annotation, exclus puis marqués — un mot n'est rendu qu'une fois.
+    """
+    boxes, words, lines = _page_words_cache(page)
+    if not words:
+        return ""
+    # mot retenu si son centre est dans r : les boîtes de mots couvrent toute la hauteur
+    # de ligne (un simple recouvrement attraperait les lignes voisines du quad), et un mot
+    # à peine effleuré par le bord du quad n'est pas pris
+    cx = (boxes[:, 0] + boxes[:, 2]) * 0.5
+    cy = (boxes[:, 1] + boxes[:, 3]) * 0.5
+    inside = (cx >= r.x0) & (cx <= r.x1) & (cy >= r.y0) & (cy <= r.y1)
+    if taken is not None:
+        inside &= ~taken
+        taken |= inside
+    out, prev = [], None
+    for i in np.flatnonzero(inside):
+        if prev is not None:
+            out.append(" " if lines[i] == prev else "\n")
+        out.append(words[i])
+        prev = lines[i]
+    return "".join(out)
+
+def _words_taken(page: fitz.Page) -> np.ndarray:
+    """Masque « mot déjà pris » vierge pour une annotation (cf. text_in_rect)."""
+    return np.zeros(len(_page_words_cache(page)[1]), dtype=bool)
+
+def _merge_quad_rects(rects: np.ndarray, min_overlap: float = 0.3) -> np.ndarray:
+    """
+    Fusionne les rects consécutifs d'une annotation qui se recouvrent de plus de
+    `min_overlap` de l'aire du plus petit (quads par mot qui débordent de 1-2 px sur
+    le voisin, émis par certains producteurs). L'ordre des quads est conservé.
+    """
+    if len(rects) < 2:
+        return rects
+    out = [rects[0].copy()]
+    for r in rects[1:]:
+        m = out[-1]
+        iw = min(m[2], r[2]) - max(m[0], r[0])
+        ih = min(m[3], r[3]) - max(m[1], r[1])
+        if iw > 0 and ih > 0:
+            small = min((m[2] - m[0]) * (m[3] - m[1]), (r[2] - r[0]) * (r[3] - r[1]))
+            if iw * ih > min_overlap * small:
+                m[:2] = np.minimum(m[:2], r[:2])
+                m[2:] = np.maximum(m[2:], r[2:])
+                continue
+        out.append(r.copy())
+    return np.array(out, dtype=np.float32)
+
+def texts_from_rects(page: fitz.Page, rects: np.ndarray) -> Tuple[List[str], np.ndarray]:
+    """
+    Texte sous chaque rect d'un tableau (n,4) ; seuls les rects qui couvrent du texte
+    sont gardés. Les bboxes restent un tableau float32 (rects après fusion des quads
+    redondants), sérialisé tel quel par orjson. Chaque mot n'est compté qu'une fois.
+    """
+    rects = _merge_quad_rects(rects)
+    taken = _words_taken(page)
+    texts: List[str] = []
+    keep = np.zeros(len(rects), dtype=bool)
+    for i, row in enumerate(rects):
+        t = text_in_rect(page, fitz.Rect(*row), taken)
+        if t:
+            texts.append(t)
+            keep[i] = True
+    return texts, rects[keep]
+
+_JSON_SAFE = (str, bool, int, type(None))
+
+def _sanitize_json(x: Any) -> Any:
+    """
+    Rend tout sérialisable JSON (NaN/Inf→None, tuples→list, Rect→bbox).
+    Sert de `default` à orjson pour les types qu'il ne connaît pas (ex. bytes d'image
+    du rawdict) ; nos propres sorties sont construites directement sérialisables.
+    Parcours itératif (pile explicite) : pas de frame Python par nœud.
+    """
+    root: List[Any] = [None]
+    stack: List[Tuple[Any, Any, Any]] = [(root, 0, x)]
+    while stack:
+        parent, key, v = stack.pop()
+        if isinstance(v, _JSON_SAFE):
+            parent[key] = v
+        elif isinstance(v, float):
+            parent[key] = v if isfinite(v) else None
+        elif isinstance(v, (list, tuple)):
+            out: Any = [None] * len(v)
+            parent[key] = out
+            stack.extend((out, i, item) for i, item in enumerate(v))
+        elif isinstance(v, dict):
+            out = {str(k): None for k in v}
+            parent[key] = out
+            # empilés à l'envers : dépilés dans l'ordre, la dernière clé dupliquée gagne
+            stack.extend((out, str(k), item) for k, item in reversed(list(v.items())))
+        elif hasattr(v, "x0") and hasattr(v, "y0") and hasattr(v, "x1") and hasattr(v, "y1"):
+            try:
+                parent[key] = [float(v.x0), float(v.y0), float(v.x1), float(v.y1)]
+            except Exception:
+                parent[key] = None
+        else:
+            parent[key] = str(v)
+    return root[0]
+
+def _rect_tuple(r) -> Tuple[float, float, float, float]:
+    """Rect → (x0, y0, x1, y1) ; orjson l'écrit en tableau, NaN/Inf → null."""
+    return (r.x0, r.y0, r.x1, r.y1)
+
+_RECT_INDEX_MIN = 64   # en dessous, la matrice dense reste moins chère que l'index
+_SPAN_BLOCK = 64
+
+def _overlap_block(S: np.ndarray, R: np.ndarray, s_idx: np.ndarray, r_idx: np.ndarray,
+                   min_iou: float, hits: List[List[int]]):
+    tl = np.maximum(S[:, None, :2], R[None, :, :2])
+    br = np.minimum(S[:, None, 2:], R[None, :, 2:])
+    iw = np.clip(br - tl, 0, None)
+    inter = iw[..., 0] * iw[..., 1]
+    area_s = (S[:, 2] - S[:, 0]) * (S[:, 3] - S[:, 1])
+    area_r = (R[:, 2] - R[:, 0]) * (R[:, 3] - R[:, 1])
+    iou = inter / np.maximum(area_s[:, None] + area_r[None, :] - inter, 1e-6)
+    # inter > 0 : des rects seulement adjacents (bord commun) ne se recouvrent pas
+    for i, j in np.argwhere((inter > 0) & (iou >= min_iou)):
+        hits[int(s_idx[i])].append(int(r_idx[j]))
+
+def _overlap_hits(S: np.ndarray, R: np.ndarray, min_iou: float = 0.05) -> List[List[int]]:
+    """
+    Recouvrements S (N,4) × R (M,4) → pour chaque ligne de S, indices des rects de R
+    qui la recouvrent avec IoU >= min_iou (dans l'ordre de R).
+    Au-delà de _RECT_INDEX_MIN rects, R est indexé par y0 trié : chaque bloc de spans
+    (triés par y0) n'est comparé qu'à la fenêtre de rects qui peut le recouvrir.
+    """
+    hits: List[List[int]] = [[] for _ in range(len(S))]
+    if len(S) == 0 or len(R) == 0:
+        return hits
+    if len(R) < _RECT_INDEX_MIN:
+        _overlap_block(S, R, np.arange(len(S)), np.arange(len(R)), min_iou, hits)
+        return hits
+
+    r_order = np.argsort(R[:, 1], kind="stable")
+    r_y0 = R[r_order, 1]
+    max_h = float((R[:, 3] - R[:, 1]).max())
+    s_order = np.argsort(S[:, 1], kind="stable")
+    for k in range(0, len(S), _SPAN_BLOCK):
+        s_idx = s_order[k:k + _SPAN_BLOCK]
+        # un rect recouvre un span seulement si span.y0 - max_h < rect.y0 < span.y1
+        lo = np.searchsorted(r_y0, S[s_idx, 1].min() - max_h, side="left")
+        hi = np.searchsorted(r_y0, S[s_idx, 3].max(), side="left")
+        if hi <= lo:
+            continue
+        r_idx = np.sort(r_order[lo:hi])   # ordre d'origine → mêmes échantillons qu'avant
+        _overlap_block(S[s_idx], R[r_idx], s_idx, r_idx, min_iou, hits)
+    return hits
+
+_TEXT_MARKUP_TYPES = (fitz.PDF_ANNOT_HIGHLIGHT, fitz.PDF_ANNOT_UNDERLINE,
+                      fitz.PDF_ANNOT_SQUIGGLY, fitz.PDF_ANNOT_STRIKE_OUT)   # 8, 9, 10, 11
+_TEXT_MARKUP_CODES = frozenset(_TEXT_MARKUP_TYPES)
+# Annot.type = (code, nom[, intent]) ; Annot.colors = {"stroke": [...], "fill": [...]} (listes
+# éventuellement vides) : lus directement dans les boucles, sans getattr ni défaut.
 
 def _collect_text_markup_annots(page: fitz.Page):
     """Liste compacte d'annotations Text Markup → [{type, rect, color}]"""
     out = []
     try:
-        annots = page.annots()
+        # seuls les types Text Markup sont chargés (filtre côté MuPDF)
+        annots = page.annots(types=_TEXT_MARKUP_TYPES)
     except Exception:
         annots = None
     if not annots:
@@ -75,32 +312,11 @@ def _collect_text_markup_annots(page: fitz.Page):
 
     for a in annots:
         try:
-            name = (getattr(a, "typeString", "") or "").lower()
-            if not any(k in name for k in ["highlight", "underline", "strike", "squiggly"]):
-                continue
-            color = None
-            try:
-                colors = getattr(a, "colors", None) or {}
-                color = colors.get("stroke", None)  # stroke color pour Highlight
-            except Exception:
-                pass
-
-            v = getattr(a, "vertices", None)
-            rects: List[fitz.Rect] = []
-            if v and hasattr(v, "__len__") and len(v) > 0:
-                # 3 formats possibles: Quads, Points (4*n), liste plate (8*n)
-                if hasattr(v[0], "rect"):
-                    rects = [q.rect for q in v]
-                elif hasattr(v[0], "x") and hasattr(v[0], "y"):
-                    for i in range(0, len(v), 4):
-                        if i + 3 < len(v):
-                            q = fitz.Quad([v[i], v[i+1], v[i+2], v[i+3]])
-                            rects.append(q.rect)
-                elif isinstance(v[0], (int, float)):
-                    for i in range(0, len(v), 8):
-                        if i + 7 < len(v):
-                            xs = v[i:i+8][0::2]; ys = v[i:i+8][1::2]
-                            rects.append(fitz.Rect(min(xs), min(ys), max(xs), max(ys)))
+            name = a.type[1].lower()
+            color = a.colors["stroke"]  # stroke color pour Highlight
+            color = list(color) if color else None
+
+            rects = [fitz.Rect(*row) for row in _quads_to_rects(a.vertices)]
             if not rects:
                 rects = [a.rect]
 
@@ -114,7 +330,7 @@ def _collect_visual_highlights(page: fitz.Page):
     """
     Détecte des remplissages vectoriels (rectangles / paths remplis).
     On utilise page.get_drawings(); sinon fallback bboxlog.
-    Renvoie [{rect, fill}] (fill = (r,g,b) 0..1 ou None).
+    Renvoie [{rect, fill}] (fill = [r,g,b] 0..1 ou None).
     """
     visual = []
     try:
@@ -124,6 +340,7 @@ def _collect_visual_highlights(page: fitz.Page):
             if not fill:
                 continue
             r = d.get("rect", None)
+            fill = list(fill)
             if r:
                 visual.append({"rect": r, "fill": fill})
                 continue
@@ -148,11 +365,16 @@ def _collect_visual_highlights(page: fitz.Page):
             pass
     return visual
 
+_MISS = object()
+
 def _spans_compacts(page: fitz.Page) -> List[Dict[str, Any]]:
     """Texte compact + marquages (annotations & visuels)."""
     spans: List[Dict[str, Any]] = []
 
     # 1) spans texte
+    page_no = page.number + 1
+    # peu de couleurs distinctes par page : conversions mémorisées
+    color_cache: Dict[int, Optional[List[int]]] = {}
     d = page.get_text("dict") or {}
     for bi, b in enumerate(d.get("blocks", []) or []):
         if int(b.get("type", 0)) != 0:   # 0 = texte ; 1 = image
@@ -164,18 +386,23 @@ def _spans_compacts(page: fitz.Page) -> List[Dict[str, Any]]:
                     continue
                 font = str(s.get("font") or "")
                 flags = int(s.get("flags") or 0)
-                is_bold = ("bold" in font.lower()) or (flags != 0)
-                bbox = [float(x) for x in (s.get("bbox") or [])]
+                is_bold = _font_is_bold(font) or (flags != 0)
+                size = s.get("size")
                 color = s.get("color")
-                try:
-                    color_rgb = list(fitz.sRGB_to_rgb(int(color))) if isinstance(color, int) else None
-                except Exception:
-                    color_rgb = None
+                color_rgb = None
+                if isinstance(color, int):
+                    color_rgb = color_cache.get(color, _MISS)
+                    if color_rgb is _MISS:
+                        try:
+                            color_rgb = list(fitz.sRGB_to_rgb(color))
+                        except Exception:
+                            color_rgb = None
+                        color_cache[color] = color_rgb
                 spans.append({
-                    "page": page.number + 1,
+                    "page": page_no,
                     "block": bi, "line": li, "span": si,
-                    "text": t, "bbox": bbox,
-                    "font": font, "size": s.get("size"),
+                    "text": t, "bbox": s.get("bbox"),
+                    "font": font, "size": size,
                     "is_bold": is_bold, "color_rgb": color_rgb
                 })
 
@@ -186,53 +413,498 @@ def _spans_compacts(page: fitz.Page) -> List[Dict[str, Any]]:
     annot_rects = _collect_text_markup_annots(page)   # quads → rects + color
     visual_rects = _collect_visual_highlights(page)   # rectangles / paths remplis
 
-    for s in spans:
-        r = fitz.Rect(*s["bbox"])
+    # IoU span × marquage calculé en bloc (numpy), puis on ne parcourt que les hits.
+    # Les bbox restent des lignes float32 de S / A / V : orjson (OPT_SERIALIZE_NUMPY) les
+    # écrit telles quelles (NaN → null), sans liste de floats Python par boîte.
+    S = np.array([s["bbox"] for s in spans], dtype=np.float32).reshape(-1, 4)
+    A = np.array([_rect_tuple(a["rect"]) for a in annot_rects], dtype=np.float32).reshape(-1, 4)
+    V = np.array([_rect_tuple(v["rect"]) for v in visual_rects], dtype=np.float32).reshape(-1, 4)
+    annot_hits = _overlap_hits(S, A, min_iou=0.05)
+    visual_hits = _overlap_hits(S, V, min_iou=0.05)
+
+    for i, s in enumerate(spans):
+        s["bbox"] = S[i]
 
         # a) annotations PDF (Text Markup)
         types, samples = set(), []
-        for a in annot_rects:
-            if _rects_overlap(r, a["rect"], min_iou=0.05):
-                types.add(a["type"])
-                samples.append({
-                    "bbox": [float(a["rect"].x0), float(a["rect"].y0), float(a["rect"].x1), float(a["rect"].y1)],
-                    "color_rgb": list(a["color"]) if a["color"] else None
-                })
-                if len(samples) >= 2:
-                    break
+        for j in annot_hits[i]:
+            a = annot_rects[j]
+            types.add(a["type"])
+            samples.append({
+                "bbox": A[j],
+                "color_rgb": a["color"]
+            })
+            if len(samples) >= 2:
+                break
         s["annot_mark"] = {"has": bool(types), "types": sorted(types), "samples": samples if types else []}
 
         # b) surlignages visuels (remplissages)
         vs = []
-        for v in visual_rects:
-            if _rects_overlap(r, v["rect"], min_iou=0.05):
-                vs.append({
-                    "bbox": [float(v["rect"].x0), float(v["rect"].y0), float(v["rect"].x1), float(v["rect"].y1)],
-                    "fill_rgb": list(v["fill"]) if v.get("fill") else None
-                })
-                if len(vs) >= 2:
-                    break
+        for j in visual_hits[i]:
+            v = visual_rects[j]
+            vs.append({
+                "bbox": V[j],
+                "fill_rgb": v["fill"]
+            })
+            if len(vs) >= 2:
+                break
         s["visual_mark"] = {"has": bool(vs), "samples": vs}
 
     return spans
 
+# ---------- Pages ----------
+_SOA_FIELDS = ("text", "bbox", "font", "size", "flags", "color", "is_bold", "block", "line")
+
+def _text_soa(d: Dict[str, Any], truncate_span: Optional[int]) -> Dict[str, Any]:
+    """
+    dict MuPDF → {"spans": {champ: [...]}} : une liste par champ, indices alignés
+    (span i = text[i], bbox[i], …, block[i]/line[i] = position dans le dict).
+    Une dizaine de listes au lieu d'un dict par span, bloc et ligne.
+    """
+    cols: Dict[str, List[Any]] = {k: [] for k in _SOA_FIELDS}
+    text, bbox, font, size, flags, color, is_bold, block, line = (cols[k] for k in _SOA_FIELDS)
+    L = truncate_span
+    for bi, b in enumerate(d.get("blocks", []) or []):
+        for li, l in enumerate(b.get("lines", []) or []):
+            for s in l.get("spans", []) or []:
+                t = s.get("text") or ""
+                if L is not None and len(t) > L:
+                    t = t[:L]
+                f = str(s.get("font") or "")
+                fl = s.get("flags") or 0
+                text.append(t)
+                bbox.append(s.get("bbox"))
+                font.append(f)
+                size.append(s.get("size"))
+                flags.append(fl)
+                color.append(s.get("color"))
+                is_bold.append(_font_is_bold(f) or bool(fl))
+                block.append(bi)
+                line.append(li)
+    return {"spans": cols}
+
+def _parse_page(page: fitz.Page, compact: bool, truncate_span: Optional[int],
+                detail: str = "dict") -> Dict[str, Any]:
+    """
+    Corps de /parse pour une page → page_obj.
+    text_raw : "dict" MuPDF, "rawdict" (par caractère) ou "spans" (colonnes, cf. _text_soa).
+    """
+    pno = page.number + 1
+
+    if compact:
+        spans = _spans_compacts(page)
+        if truncate_span is not None:
+            for s in spans:
+                if isinstance(s.get("text"), str) and len(s["text"]) > truncate_span:
+                    s["text"] = s["text"][:truncate_span]
+        return {"number": pno, "spans": spans}
+
+    # version complète: dict (ou rawdict) + annotations
+    try:
+        # une seule analyse de mise en page pour le dict et les mots sous les annotations
+        # (TEXTFLAGS_DICT = TEXTFLAGS_RAWDICT = TEXTFLAGS_WORDS + images : mêmes mots). Sans
+        # clip : une TextPage fournie à get_text ignore clip=, les quads passent par le cache de mots.
+        page._textpage = page.get_textpage(flags=fitz.TEXTFLAGS_DICT)
+        raw = page.get_text("rawdict" if detail == "rawdict" else "dict", textpage=page._textpage) or {}
+    except Exception:
+        logger.exception("%s failed on page %s", detail, pno)
+        raw = {}
+    L = truncate_span
+    try:
+        if detail == "spans":
+            raw = _text_soa(raw, L)
+        else:
+            for b in raw.get("blocks", []) or []:
+                for l in b.get("lines", []) or []:
+                    for s in l.get("spans", []) or []:
+                        s["is_bold"] = _font_is_bold(str(s.get("font") or "")) or bool(s.get("flags"))
+                        if L is not None:
+                            t = s.get("text")
+                            if isinstance(t, str) and len(t) > L:
+                                s["text"] = t[:L]
+    except Exception:
+        logger.exception("post-process text_raw spans failed")
+
+    annots_json = []
+    try:
+        annots = page.annots()
+    except Exception:
+        annots = None
+    if annots:
+        for a in annots:
+            try:
+                code, name = a.type[:2]   # (code, nom) ou (code, nom, intent) si /IT
+                is_text_markup = code in _TEXT_MARKUP_CODES
+                name = name.lower()
+                color = a.colors["stroke"]
+
+                boxes, texts = [], []
+                if is_text_markup:
+                    v = a.vertices
+                    taken = _words_taken(page)
+
+                    def add_rect(r: fitz.Rect):
+                        t = text_in_rect(page, r, taken)
+                        if t:
+                            if truncate_span is not None and len(t) > truncate_span:
+                                t = t[:truncate_span]
+                            texts.append(t)
+                            boxes.append(_rect_tuple(r))
+
+                    for row in _merge_quad_rects(_quads_to_rects(v)):
+                        add_rect(fitz.Rect(*row))
+                    if not texts:
+                        add_rect(a.rect)
+                else:
+                    r = a.rect
+                    boxes.append(_rect_tuple(r))
+
+                annots_json.append({
+                    "type": name,
+                    "color_rgb": list(color) if color else None,
+                    "boxes": boxes,
+                    "text": " ".join(texts).strip()
+                })
+            except Exception:
+                logger.exception("failed to process annotation on page %s", pno)
+
+    return {"number": pno, "text_raw": raw, "annotations": annots_json}
+
+def _extract_page(page: fitz.Page) -> List[Dict[str, Any]]:
+    """Corps de /extract pour une page → highlights de la page."""
+    results: List[Dict[str, Any]] = []
+    page_no = page.number + 1
+    # filtre fait côté MuPDF : les autres annotations (liens, widgets…) ne sont pas chargées
+    for annot in page.annots(types=(fitz.PDF_ANNOT_HIGHLIGHT,)):
+        color = annot.colors["stroke"]
+        # _quads_to_rects aiguille sur le type des vertices (format inconnu → aucun rect)
+        texts, boxes = texts_from_rects(page, _quads_to_rects(annot.vertices))
+        if not texts:
+            texts, boxes = texts_from_rects(page, np.array([tuple(annot.rect)], dtype=np.float32))
+        if texts:
+            results.append({
+                "page": page_no,
+                # chaque morceau est déjà sans espace en bord : pas de strip()
+                "text": " ".join(texts),
+                "color_rgb": list(color) if color else None,
+                "boxes": boxes,
+            })
+    return results
+
+def _fulltext_page(page: fitz.Page) -> Dict[str, Any]:
+    """Corps de /fulltext pour une page."""
+    return {"page": page.number + 1, "text": page.get_text("text")}
+
+_PAGE_HANDLERS = {"parse": _parse_page, "extract": _extract_page, "fulltext": _fulltext_page}
+
+# ---------- Process pool ----------
+# Un pool par worker gunicorn : le total de process MuPDF est workers × POOL_WORKERS.
+# Par défaut on partage donc les CPU entre les workers gunicorn (même WEB_CONCURRENCY que
+# gunicorn.conf.py) ; avec un worker par CPU (défaut), le pool est désactivé et le
+# parallélisme vient des workers. PDF_POOL_WORKERS=1 désactive le pool explicitement.
+MIN_PAGES_FOR_MP = int(os.getenv("PDF_POOL_MIN_PAGES", "8"))   # en dessous, le coût IPC/réouverture dépasse le gain
+_CPUS = os.cpu_count() or 1
+_WEB_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", str(_CPUS))))
+POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", str(max(1, min(_CPUS // _WEB_WORKERS, 4)))))
+_POOL_LOCK = threading.Lock()
+# Pool créé pendant une requête, dans un worker gthread où d'autres threads tiennent des
+# verrous (MuPDF, logging) : un fork direct peut laisser un process figé sur l'un d'eux.
+# Le forkserver (mono-thread) importe ce module une fois, les process du pool en sont forkés.
+_MP_CONTEXT = multiprocessing.get_context("forkserver")
+_MP_CONTEXT.set_forkserver_preload([__name__])
+
+def _init_worker():
+    """
+    Initialisation d'un process du pool. fitz est déjà importé et MuPDF chauffé : le
+    forkserver a importé ce module (set_forkserver_preload) avant de forker le process.
+    Reste l'état propre au process : Ctrl-C / arrêt de gunicorn gérés par le parent seul,
+    messages MuPDF silencieux.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    fitz.TOOLS.mupdf_display_errors(False)
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    Pool de process partagé entre requêtes, rangé dans app.extensions["pdf_pool"].
+    Créé au premier usage, donc dans chaque worker gunicorn et pas dans le master
+    (preload_app) : un pool ne survit pas à un fork.
+    """
+    pool = app.extensions.get("pdf_pool")
+    if pool is None:
+        with _POOL_LOCK:
+            pool = app.extensions.get("pdf_pool")
+            if pool is None:
+                pool = app.extensions["pdf_pool"] = ProcessPoolExecutor(
+                    max_workers=POOL_WORKERS, mp_context=_MP_CONTEXT,
+                    initializer=_init_worker)
+    return pool
+
+def _drop_executor(pool: ProcessPoolExecutor):
+    """Oublie un pool cassé (process tué : segfault MuPDF, OOM) ; le prochain appel en recrée un."""
+    with _POOL_LOCK:
+        if app.extensions.get("pdf_pool") is pool:
+            del app.extensions["pdf_pool"]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _process_pages(shm_name: str, size: int, pnos: List[int], kind: str,
+                   options: Dict[str, Any]) -> List[Any]:
+    """Exécuté dans un worker : lit le PDF en mémoire partagée, l'ouvre une fois
+    et traite un bloc de pages (1-based)."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # copie locale : MuPDF garde une référence sur le buffer passé à fitz.open
+        pdf_bytes = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    doc = _open_doc(pdf_bytes)
+    try:
+        handler = _PAGE_HANDLERS[kind]
+        return [handler(doc[pno - 1], **options) for pno in pnos]
+    finally:
+        doc.close()
+        _shrink_mupdf_store()
+
+def _map_pages(doc: fitz.Document, pdf_bytes: bytes, page_numbers: List[int],
+               kind: str, options: Optional[Dict[str, Any]] = None) -> Iterator[Any]:
+    """Résultats par page, dans l'ordre de page_numbers (inline pour les petits PDF)."""
+    options = options or {}
+    if len(page_numbers) < MIN_PAGES_FOR_MP or POOL_WORKERS < 2:
+        return (_PAGE_HANDLERS[kind](doc[pno - 1], **options) for pno in page_numbers)
+    return _map_pages_pool(pdf_bytes, page_numbers, kind, options)
+
+def _map_pages_pool(pdf_bytes: bytes, page_numbers: List[int], kind: str,
+                    options: Dict[str, Any]) -> Iterator[Any]:
+    """Version pool de _map_pages : le PDF est copié une seule fois en mémoire partagée
+    et les workers ne reçoivent que son nom (pas N Mo picklés par bloc)."""
+    shm = shared_memory.SharedMemory(create=True, size=len(pdf_bytes))
+    try:
+        shm.buf[:len(pdf_bytes)] = pdf_bytes
+        # un bloc contigu de pages par worker : chaque worker n'ouvre le PDF qu'une fois
+        size = -(-len(page_numbers) // POOL_WORKERS)
+        blocks = [page_numbers[i:i + size] for i in range(0, len(page_numbers), size)]
+        done = 0
+        for attempt in range(2):
+            pool = _get_executor()
+            todo = blocks[done:]
+            n = len(todo)
+            try:
+                results = pool.map(_process_pages, [shm.name] * n, [len(pdf_bytes)] * n,
+                                   todo, [kind] * n, [options] * n)
+                for block in results:
+                    yield from block
+                    done += 1
+                break
+            except BrokenProcessPool:
+                # pool recréé, blocs non encore rendus relancés une fois
+                _drop_executor(pool)
+                if attempt:
+                    raise
+                logger.warning("page pool broken, restarting it (%d/%d blocks done)", done, len(blocks))
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _with_first_page(pages: Iterator[Any], doc: fitz.Document) -> Iterator[Any]:
+    """
+    Calcule la 1re page avant que la route ne renvoie le flux (statut 200 envoyé) : une
+    erreur de page ou de pool remonte encore dans le try de la route (500 JSON, debug=1)
+    au lieu de tronquer un JSON déjà commencé. Les pages suivantes restent paresseuses.
+    """
+    try:
+        first = next(pages, _MISS)
+    except Exception:
+        pages.close()
+        doc.close()
+        raise
+    return iter(()) if first is _MISS else chain((first,), pages)
+
+# ---------- JSON ----------
+def _dumps(obj: Any) -> bytes:
+    """orjson (NaN/Inf→null natif, tuples→listes) ; _sanitize_json pour le reste."""
+    return orjson.dumps(obj, default=_sanitize_json, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def _json_response(body: bytes, etag: Optional[str] = None, status: int = 200) -> Response:
+    resp = Response(body, status=status, mimetype="application/json")
+    if etag is not None:
+        resp.set_etag(etag)
+    return resp
+
+def _json(obj: Any, status: int = 200) -> Response:
+    """Équivalent de jsonify() (réponses d'erreur, santé) via orjson."""
+    return _json_response(_dumps(obj), status=status)
+
+def _stream_json(chunks: Iterator[bytes], etag: Optional[str] = None) -> Response:
+    if etag is not None:
+        chunks = _cache_stream(etag, chunks)
+    resp = Response(stream_with_context(chunks), status=200, mimetype="application/json")
+    if etag is not None:
+        resp.set_etag(etag)
+    return resp
+
+# ---------- Response cache ----------
+# Réponses déjà calculées, par empreinte SHA-256 du PDF + route + options (LRU en mémoire
+# du process). Les clients renvoient souvent le même PDF (retries, découpage par pages).
+# PDF_CACHE_MAXSIZE=0 désactive le cache.
+# Version du service et du format de sortie : entre dans l'ETag, à incrémenter à chaque
+# changement de sortie pour qu'un client ne revalide (304) pas un corps d'une version antérieure.
+SERVICE_VERSION = "1.6.0"
+CACHE_MAX_ENTRIES = int(os.getenv("PDF_CACHE_MAXSIZE", "128"))
+CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_MB", "200")) * 1024 * 1024
+# Corps streamés (/parse, /fulltext) : mis en cache seulement s'ils restent petits, sinon
+# la copie gardée pour le cache annulerait le gain mémoire du streaming.
+CACHE_MAX_STREAM_BYTES = int(os.getenv("PDF_CACHE_STREAM_MAX_MB", "4")) * 1024 * 1024
+_RESPONSE_CACHE: "OrderedDict[str, bytes]" = OrderedDict()
+_RESPONSE_CACHE_BYTES = 0
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+def _response_etag(pdf_bytes: bytes, variant: str = "") -> str:
+    """ETag (et clé de cache) de la réponse : PDF + version + route + options qui changent la sortie."""
+    digest = hashlib.sha256(pdf_bytes).digest()
+    return hashlib.sha256(digest + f"{SERVICE_VERSION}:{request.path}?{variant}".encode()).hexdigest()
+
+def _cached_response(etag: str) -> Optional[Response]:
+    """304 si le client a déjà cette version, réponse en cache si présente, sinon None."""
+    # Flask-Compress suffixe l'ETag des réponses compressées ("<etag>:gzip"). "*" est ignoré :
+    # sur ces POST il renverrait un 304 sans corps quel que soit le PDF envoyé.
+    inm = request.if_none_match
+    if not inm.star_tag and any(inm.contains(etag + sfx) for sfx in ("", ":zstd", ":gzip")):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    with _RESPONSE_CACHE_LOCK:
+        body = _RESPONSE_CACHE.get(etag)
+        if body is not None:
+            _RESPONSE_CACHE.move_to_end(etag)
+    if body is None:
+        return None
+    return _json_response(body, etag)
+
+def _cache_store(etag: str, body: bytes):
+    global _RESPONSE_CACHE_BYTES
+    if CACHE_MAX_ENTRIES <= 0 or len(body) > CACHE_MAX_BYTES // 4:
+        return
+    with _RESPONSE_CACHE_LOCK:
+        old = _RESPONSE_CACHE.pop(etag, None)
+        if old is not None:
+            _RESPONSE_CACHE_BYTES -= len(old)
+        _RESPONSE_CACHE[etag] = body
+        _RESPONSE_CACHE_BYTES += len(body)
+        while len(_RESPONSE_CACHE) > CACHE_MAX_ENTRIES or _RESPONSE_CACHE_BYTES > CACHE_MAX_BYTES:
+            _, evicted = _RESPONSE_CACHE.popitem(last=False)
+            _RESPONSE_CACHE_BYTES -= len(evicted)
+
+def _cache_stream(etag: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    Relaie un flux et met le corps complet en cache s'il va jusqu'au bout et ne dépasse
+    pas CACHE_MAX_STREAM_BYTES ; au-delà, les morceaux ne sont plus gardés.
+    """
+    parts: Optional[List[bytes]] = [] if CACHE_MAX_ENTRIES > 0 else None
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > CACHE_MAX_STREAM_BYTES:
+                parts = None   # trop gros pour le cache : on relaie seulement
+        yield chunk
+    if parts is not None:
+        _cache_store(etag, b"".join(parts))
+
+# ---------- Request body ----------
+def _read_body(stream, length: Optional[int]) -> Union[bytes, bytearray]:
+    """
+    Lit le corps directement dans un bytearray de la taille annoncée (Content-Length) :
+    une seule copie du PDF en RAM, là où read() accumule par blocs puis recopie en bytes.
+    length doit être déjà borné (MAX_CONTENT_LENGTH) : il est alloué avant toute lecture.
+    """
+    if not length:
+        return stream.read()
+    buf = bytearray(length)
+    view = memoryview(buf)
+    n = 0
+    while n < length:
+        k = stream.readinto(view[n:])
+        if not k:
+            break
+        n += k
+    view.release()
+    if n < length:
+        del buf[n:]
+    return buf
+
+@app.before_request
+def _stash_pdf_body():
+    """Corps application/pdf lu une seule fois, gardé dans g.pdf_bytes pour la requête."""
+    if request.content_type and "application/pdf" in (request.content_type or "").lower():
+        g.pdf_bytes = _read_body(request.stream, request.content_length)
+
+def _read_pdf_bytes() -> Union[bytes, bytearray, Response]:
+    """Octets du PDF (application/pdf ou multipart 'file'), ou réponse 400 prête à renvoyer."""
+    pdf_bytes = g.get("pdf_bytes")
+    if pdf_bytes is None:
+        f = request.files.get("file")
+        if not f:
+            return _json({"error": "No PDF provided (send as application/pdf, or multipart with field 'file')"}, 400)
+        # partie multipart déjà spoolée sur disque par Werkzeug au-delà de 500 Ko. Son
+        # Content-Length est écrit par le client et non borné par MAX_CONTENT_LENGTH : on ne
+        # préalloue que s'il tient dans le corps de la requête, déjà vérifié par Werkzeug.
+        part_length = f.content_length
+        if not 0 < part_length <= (request.content_length or 0):
+            part_length = None
+        pdf_bytes = _read_body(f.stream, part_length)
+    if not pdf_bytes:
+        return _json({"error": "Empty request body"}, 400)
+    return pdf_bytes
+
+def _open_doc(pdf_bytes: bytes) -> fitz.Document:
+    """PyMuPDF lit directement bytes/bytearray : pas d'enveloppe BytesIO ni de copie."""
+    return fitz.open(stream=pdf_bytes, filetype="pdf")
+
+@app.teardown_request
+def _release_mupdf(exc):
+    # après la fin du streaming (stream_with_context garde le contexte jusque-là)
+    _shrink_mupdf_store()
+
 # ---------- Error handlers ----------
 @app.errorhandler(400)
 def handle_400(err):
-    return jsonify({"error": "Bad Request", "detail": str(err)}), 400
+    return _json({"error": "Bad Request", "detail": str(err)}, 400)
+
+@app.errorhandler(413)
+def handle_413(err):
+    limit = app.config["MAX_CONTENT_LENGTH"]
+    if limit is None:
+        return _json({"error": "Payload Too Large", "detail": str(err)}, 413)
+    return _json({"error": "Payload Too Large", "detail": f"PDF larger than {limit // (1024 * 1024)} MB"}, 413)
 
 @app.errorhandler(404)
 def handle_404(err):
-    return jsonify({"error": "Not Found"}), 404
+    return _json({"error": "Not Found"}, 404)
 
 @app.errorhandler(500)
 def handle_500(err):
-    return jsonify({"error": "Internal Server Error"}), 500
+    return _json({"error": "Internal Server Error"}, 500)
 
 # ---------- Routes ----------
+_PAGE_TOKEN_RE = re.compile(r"^\s*(\d+)(?:\s*-\s*(\d+))?\s*$")   # "1-3" → (1, 3), "5" → (5, None)
+
+@lru_cache(maxsize=1024)
+def _parse_pages(spec: str, n: int) -> Tuple[int, ...]:
+    """ "1-3,5" → (1, 2, 3, 5), bornés à [1, n] ; tuple vide ⇒ toutes les pages.
+    Les morceaux mal formés sont ignorés. Mémoïsé : les clients renvoient souvent
+    la même sélection."""
+    sel = set()
+    for token in spec.split(","):
+        m = _PAGE_TOKEN_RE.match(token)
+        if m:
+            sel.update(range(max(int(m.group(1)), 1), min(int(m.group(2) or m.group(1)), n) + 1))
+    return tuple(sorted(sel))
+
+_DETAILS = {"raw": "rawdict", "spans": "spans"}   # /parse?detail= → forme de text_raw
+
 @app.get("/")
 def health():
-    return jsonify({"status": "ok", "service": "pdf-annotations", "version": "1.5.0"}), 200
+    return _json({"status": "ok", "service": "pdf-annotations", "version": SERVICE_VERSION})
 
 @app.post("/parse")
 def parse_pdf():
@@ -241,291 +913,168 @@ def parse_pdf():
       - compact=1             ⇒ spans compacts + marquages
       - pages=1-3,5           ⇒ filtre de pages
       - truncate_span=200     ⇒ coupe le texte des spans
+      - detail=raw            ⇒ text_raw en rawdict (caractère par caractère) au lieu de dict
+      - detail=spans          ⇒ text_raw en colonnes : {"spans": {"text": [...], "bbox": [...], …}}
       - debug=1               ⇒ renvoie l’erreur exacte (diagnostic)
     """
-    import json
-
     q = request.args or {}
     compact = (q.get("compact") == "1")
     pages_param = (q.get("pages") or "").strip()
     trunc = q.get("truncate_span")
     truncate_span = int(trunc) if (trunc and str(trunc).isdigit()) else None
+    detail = _DETAILS.get(q.get("detail") or "", "dict")
     debug = (q.get("debug") == "1")
 
     try:
         # Lire PDF
-        if request.content_type and "application/pdf" in (request.content_type or "").lower():
-            pdf_bytes = request.get_data()
-        else:
-            f = request.files.get("file")
-            if not f:
-                return jsonify({"error": "No PDF provided (send as application/pdf, or multipart with field 'file')"}), 400
-            pdf_bytes = f.read()
-        if not pdf_bytes:
-            return jsonify({"error": "Empty request body"}), 400
+        pdf_bytes = _read_pdf_bytes()
+        if isinstance(pdf_bytes, Response):
+            return pdf_bytes
+        etag = _response_etag(pdf_bytes, f"compact={compact}&pages={pages_param}&truncate_span={truncate_span}&detail={detail}")
+        cached = _cached_response(etag)
+        if cached is not None:
+            return cached
 
         # Ouvrir PDF
         try:
-            doc = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
+            doc = _open_doc(pdf_bytes)
         except Exception as e:
-            logger.exception("fitz.open failed (/parse)")
-            return jsonify({"error": f"Failed to open PDF: {e}"}), 400
+            logger.exception("fitz.open failed (%s)", request.path)
+            return _json({"error": f"Failed to open PDF: {e}"}, 400)
 
         # Pages à traiter
-        all_nums = list(range(1, len(doc) + 1))
-        sel = set()
-        if pages_param:
-            for part in pages_param.split(","):
-                part = part.strip()
-                if "-" in part:
-                    a, b = part.split("-", 1)
-                    try:
-                        a, b = int(a), int(b)
-                        for n in range(a, b + 1):
-                            if 1 <= n <= len(doc):
-                                sel.add(n)
-                    except Exception:
-                        pass
-                else:
-                    try:
-                        n = int(part)
-                        if 1 <= n <= len(doc):
-                            sel.add(n)
-                    except Exception:
-                        pass
-        page_numbers = sorted(sel) if sel else all_nums
-
-        out_pages = []
-        approx_bytes = 0
-        BYTES_BUDGET = 28 * 1024 * 1024  # marge sous 32 MiB
-
-        for pno in page_numbers:
-            page = doc[pno - 1]
-
-            if compact:
-                spans = _spans_compacts(page)
-                if truncate_span is not None:
-                    for s in spans:
-                        if isinstance(s.get("text"), str) and len(s["text"]) > truncate_span:
-                            s["text"] = s["text"][:truncate_span]
-                page_obj = {"number": pno, "spans": spans}
-            else:
-                # version complète: rawdict + annotations
-                try:
-                    raw = page.get_text("rawdict") or {}
-                except Exception:
-                    logger.exception("rawdict failed on page %s", pno)
-                    raw = {}
-                try:
-                    for b in raw.get("blocks", []) or []:
-                        for l in b.get("lines", []) or []:
-                            for s in l.get("spans", []) or []:
-                                font = str(s.get("font") or "").lower()
-                                flags = int(s.get("flags") or 0)
-                                s["is_bold"] = ("bold" in font) or (flags != 0)
-                                if truncate_span is not None and isinstance(s.get("text"), str) and len(s["text"]) > truncate_span:
-                                    s["text"] = s["text"][:truncate_span]
-                except Exception:
-                    logger.exception("post-process rawdict spans failed")
-
-                annots_json = []
-                try:
-                    annots = page.annots()
-                except Exception:
-                    annots = None
-                if annots:
-                    for a in annots:
-                        try:
-                            name = (getattr(a, "typeString", "") or "").lower()
-                            is_text_markup = any(k in name for k in ["highlight", "underline", "strike", "squiggly"])
-                            color = None
-                            try:
-                                colors = getattr(a, "colors", None) or {}
-                                color = colors.get("stroke", None)
-                            except Exception:
-                                pass
-
-                            boxes, texts = [], []
-                            if is_text_markup:
-                                v = getattr(a, "vertices", None)
-
-                                def add_rect(r: fitz.Rect):
-                                    t = page.get_text("text", clip=r).strip()
-                                    if t:
-                                        if truncate_span is not None and len(t) > truncate_span:
-                                            t = t[:truncate_span]
-                                        texts.append(t)
-                                        boxes.append([float(r.x0), float(r.y0), float(r.x1), float(r.y1)])
-
-                                try:
-                                    if v:
-                                        if hasattr(v, "__len__") and len(v) > 0 and hasattr(v[0], "rect"):
-                                            for q in v:
-                                                add_rect(q.rect)
-                                        elif hasattr(v, "__len__") and len(v) > 0 and hasattr(v[0], "x") and hasattr(v[0], "y"):
-                                            for i in range(0, len(v), 4):
-                                                if i + 3 < len(v):
-                                                    q = fitz.Quad([v[i], v[i+1], v[i+2], v[i+3]])
-                                                    add_rect(q.rect)
-                                        elif hasattr(v, "__len__") and len(v) >= 8 and isinstance(v[0], (int, float)):
-                                            for i in range(0, len(v), 8):
-                                                if i + 7 < len(v):
-                                                    xs = v[i:i+8][0::2]; ys = v[i:i+8][1::2]
-                                                    r = fitz.Rect(min(xs), min(ys), max(xs), max(ys))
-                                                    add_rect(r)
-                                    if not texts:
-                                        add_rect(a.rect)
-                                except Exception:
-                                    try:
-                                        add_rect(a.rect)
-                                    except Exception:
-                                        pass
-                            else:
-                                r = a.rect
-                                boxes.append([float(r.x0), float(r.y0), float(r.x1), float(r.y1)])
-
-                            annots_json.append({
-                                "type": name,
-                                "color_rgb": list(color) if color else None,
-                                "boxes": boxes,
-                                "text": " ".join(texts).strip()
-                            })
-                        except Exception:
-                            logger.exception("failed to process annotation on page %s", pno)
-
-                page_obj = {"number": pno, "text_raw": raw, "annotations": annots_json}
+        page_numbers = list(_parse_pages(pages_param, len(doc)) or range(1, len(doc) + 1))
 
-            out_pages.append(page_obj)
+        BYTES_BUDGET = 28 * 1024 * 1024  # marge sous 32 MiB
+        options = {"compact": compact, "truncate_span": truncate_span, "detail": detail}
+        pages = _map_pages(doc, pdf_bytes, page_numbers, "parse", options)
+        page_objs = _with_first_page(pages, doc)
 
-            # Garde-fou taille
+        def generate() -> Iterator[bytes]:
+            # une page sérialisée à la fois ; "meta" en dernier (returned_pages connu à la fin)
+            returned, sent = 0, 0
             try:
-                approx_bytes += len(json.dumps(_sanitize_json(page_obj), ensure_ascii=False))
-                if approx_bytes > BYTES_BUDGET:
-                    break
+                yield b'{"pages":['
+                for page_obj in page_objs:
+                    chunk = _dumps(page_obj)
+                    if returned:
+                        yield b","
+                    yield chunk
+                    returned += 1
+                    # Garde-fou taille : longueur exacte des pages déjà émises
+                    sent += len(chunk)
+                    if sent > BYTES_BUDGET:
+                        break
+                meta = {"page_count": len(doc), "returned_pages": returned, "compact": compact}
+                yield b'],"meta":' + _dumps(meta) + b"}"
             except Exception:
-                pass
+                logger.exception("Unhandled error while streaming /parse")
+                raise
+            finally:
+                pages.close()   # coupure budget/client : libère le pool et sa mémoire partagée
+                doc.close()
 
-        resp = {
-            "meta": {"page_count": len(doc), "returned_pages": len(out_pages), "compact": compact},
-            "pages": out_pages
-        }
-        resp = _sanitize_json(resp)
-        return jsonify(resp), 200
+        return _stream_json(generate(), etag)
 
+    except HTTPException:
+        raise   # 413 (multipart trop gros) etc. : gérés par les errorhandlers
     except Exception as e:
         logger.exception("Unhandled error in /parse")
-        if (request.args or {}).get("debug") == "1":
-            return jsonify({"error": f"{type(e).__name__}: {e}"}), 500
-        return jsonify({"error": "Internal Server Error"}), 500
+        if debug:
+            return _json({"error": f"{type(e).__name__}: {e}"}, 500)
+        return _json({"error": "Internal Server Error"}, 500)
 
 @app.post("/extract")
 def extract():
     """Highlights uniquement (texte sous quads + couleur + bboxes + is_green)."""
     try:
-        if request.content_type and "application/pdf" in (request.content_type or "").lower():
-            pdf_bytes = request.get_data()
-        else:
-            f = request.files.get("file")
-            if not f:
-                return jsonify({"error": "No PDF provided (send as application/pdf, or multipart with field 'file')"}), 400
-            pdf_bytes = f.read()
-        if not pdf_bytes:
-            return jsonify({"error": "Empty request body"}), 400
+        pdf_bytes = _read_pdf_bytes()
+        if isinstance(pdf_bytes, Response):
+            return pdf_bytes
+        etag = _response_etag(pdf_bytes)
+        cached = _cached_response(etag)
+        if cached is not None:
+            return cached
 
         try:
-            doc = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
+            doc = _open_doc(pdf_bytes)
         except Exception as e:
-            logger.exception("fitz.open failed")
-            return jsonify({"error": f"Failed to open PDF: {e}"}), 400
+            logger.exception("fitz.open failed (%s)", request.path)
+            return _json({"error": f"Failed to open PDF: {e}"}, 400)
 
         results: List[Dict[str, Any]] = []
-        for page_index in range(len(doc)):
-            page = doc[page_index]
-            annots = page.annots()
-            if not annots:
-                continue
-            for annot in annots:
-                a_type = getattr(annot, "type", None)
-                name = getattr(annot, "typeString", "") or ""
-                code = a_type if isinstance(a_type, int) else (a_type[0] if (a_type and len(a_type) > 0) else None)
-                if not ((code == 8) or ("Highlight" in name)):
-                    continue
-                color = None
-                try:
-                    colors = getattr(annot, "colors", None) or {}
-                    color = colors.get("stroke", None)
-                except Exception:
-                    pass
-                texts: List[str] = []; bboxes: List[List[float]] = []
-                v = getattr(annot, "vertices", None)
-                try:
-                    if v:
-                        if hasattr(v[0], "rect"):
-                            for q in v:
-                                add_text_from_rect(page, q.rect, texts, bboxes)
-                        elif hasattr(v[0], "x") and hasattr(v[0], "y"):
-                            for i in range(0, len(v), 4):
-                                if i + 3 < len(v):
-                                    q = fitz.Quad([v[i], v[i+1], v[i+2], v[i+3]])
-                                    add_text_from_rect(page, q.rect, texts, bboxes)
-                        elif isinstance(v[0], (int, float)):
-                            for i in range(0, len(v), 8):
-                                if i + 7 < len(v):
-                                    r = rect_from_quad_list(v[i:i+8])
-                                    add_text_from_rect(page, r, texts, bboxes)
-                    if not texts:
-                        add_text_from_rect(page, annot.rect, texts, bboxes)
-                except Exception:
-                    try:
-                        add_text_from_rect(page, annot.rect, texts, bboxes)
-                    except Exception:
-                        pass
-                if texts:
-                    results.append({
-                        "page": page_index + 1,
-                        "text": " ".join(texts).strip(),
-                        "color_rgb": list(color) if color else None,
-                        "is_green": is_green(color),
-                        "boxes": bboxes,
-                    })
-        return jsonify({"highlights": results, "count": len(results)}), 200
+        try:
+            for page_results in _map_pages(doc, pdf_bytes, list(range(1, len(doc) + 1)), "extract"):
+                results.extend(page_results)
+        finally:
+            doc.close()
+
+        # is_green en un seul passage sur toutes les couleurs (non-RGB → pas vert)
+        if results:
+            colors = np.array([c if (c and len(c) == 3) else (0.0, 0.0, 0.0)
+                               for c in (r["color_rgb"] for r in results)], dtype=np.float64)
+            for r, is_g in zip(results, _is_green_batch(colors)):
+                r["is_green"] = bool(is_g)
+        body = _dumps({"highlights": results, "count": len(results)})
+        _cache_store(etag, body)
+        return _json_response(body, etag)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Unhandled error in /extract")
-        return jsonify({"error": f"{type(e).__name__}: {e}"}), 500
+        return _json({"error": f"{type(e).__name__}: {e}"}, 500)
 
 @app.post("/fulltext")
 def fulltext():
     """Texte brut par page (diagnostic)."""
     try:
-        if request.content_type and "application/pdf" in (request.content_type or "").lower():
-            pdf_bytes = request.get_data()
-        else:
-            f = request.files.get("file")
-            if not f:
-                return jsonify({"error": "No PDF provided (send as application/pdf, or multipart with field 'file')"}), 400
-            pdf_bytes = f.read()
-        if not pdf_bytes:
-            return jsonify({"error": "Empty request body"}), 400
+        pdf_bytes = _read_pdf_bytes()
+        if isinstance(pdf_bytes, Response):
+            return pdf_bytes
+        etag = _response_etag(pdf_bytes)
+        cached = _cached_response(etag)
+        if cached is not None:
+            return cached
 
         try:
-            doc = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
+            doc = _open_doc(pdf_bytes)
         except Exception as e:
-            logger.exception("fitz.open failed (/fulltext)")
-            return jsonify({"error": f"Failed to open PDF: {e}"}), 400
+            logger.exception("fitz.open failed (%s)", request.path)
+            return _json({"error": f"Failed to open PDF: {e}"}, 400)
+
+        pages = _map_pages(doc, pdf_bytes, list(range(1, len(doc) + 1)), "fulltext")
+        page_objs = _with_first_page(pages, doc)
 
-        pages = []
-        for i in range(len(doc)):
-            page = doc[i]
-            text = page.get_text("text")
-            pages.append({"page": i + 1, "text": text})
+        def generate() -> Iterator[bytes]:
+            # page_count connu d'avance : en tête, le client peut dimensionner avant les pages
+            first = True
+            try:
+                yield b'{"page_count":' + _dumps(len(doc)) + b',"pages":['
+                for page_obj in page_objs:
+                    chunk = _dumps(page_obj)
+                    yield chunk if first else b"," + chunk
+                    first = False
+                yield b"]}"
+            except Exception:
+                logger.exception("Unhandled error while streaming /fulltext")
+                raise
+            finally:
+                pages.close()
+                doc.close()
 
-        return jsonify({"pages": pages, "page_count": len(pages)}), 200
+        return _stream_json(generate(), etag)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Unhandled error in /fulltext")
-        return jsonify({"error": f"{type(e).__name__}: {e}"}), 500
+        return _json({"error": f"{type(e).__name__}: {e}"}, 500)
 
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", "8080"))
-    app.run(host="0.0.0.0", port=port)
+    if os.environ.get("FLASK_DEV") == "1":
+        port = int(os.environ.get("PORT", "8080"))
+        app.run(host="0.0.0.0", port=port)
+    else:
+        # serveur de production : gunicorn (voir gunicorn.conf.py / Procfile)
+        os.execvp("gunicorn", ["gunicorn", "main:app"])